@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import msgpack
+
 from sentry.utils import json
 from sentry.utils.redis import get_cluster_from_options, redis_clusters
 
@@ -10,17 +12,38 @@ class ValueTooLarge(Exception):
     pass
 
 
+def _msgpack_dumps(value):
+    # Fall back to the JSON encoder so both codecs accept the same values.
+    return msgpack.packb(value, use_bin_type=True, default=json.better_default_encoder)
+
+
+def _msgpack_loads(value):
+    return msgpack.unpackb(value, raw=False)
+
+
+# Serializers selectable through the ``codec`` cache option, as
+# ``(dumps, loads)`` pairs. msgpack is more compact and cheaper to encode
+# than JSON for the large nested dicts stored during event processing,
+# but values written with one codec cannot be read with the other, so
+# switching requires an empty cache (e.g. a new ``CACHE_VERSION``).
+CODECS = {"json": (json.dumps, json.loads), "msgpack": (_msgpack_dumps, _msgpack_loads)}
+
+
 class CommonRedisCache(BaseCache):
     key_expire = 60 * 60  # 1 hour
     max_size = 50 * 1024 * 1024  # 50MB
 
-    def __init__(self, client, **options):
+    def __init__(self, client, codec="json", **options):
+        try:
+            self._dumps, self._loads = CODECS[codec]
+        except KeyError:
+            raise ValueError(u"Unknown cache codec: {!r}".format(codec))
         self.client = client
         BaseCache.__init__(self, **options)
 
     def set(self, key, value, timeout, version=None, raw=False):
         key = self.make_key(key, version=version)
-        v = json.dumps(value) if not raw else value
+        v = self._dumps(value) if not raw else value
         if len(v) > self.max_size:
             raise ValueTooLarge("Cache key too large: %r %r" % (key, len(v)))
         if timeout:
@@ -36,7 +59,7 @@ class CommonRedisCache(BaseCache):
         key = self.make_key(key, version=version)
         result = self.client.get(key)
         if result is not None and not raw:
-            result = json.loads(result)
+            result = self._loads(result)
         return result
 
 
@@ -1,15 +1,37 @@
 from __future__ import absolute_import
 
+import random
+import time
+
 from django.core.urlresolvers import reverse
+from django.utils.functional import cached_property
 
+from sentry.app import locks
 from sentry.integrations.client import ApiClient
-from sentry.shared_integrations.exceptions import ApiError, ApiUnauthorized
+from sentry.models import Identity
+from sentry.shared_integrations.exceptions import (
+    ApiError,
+    ApiHostError,
+    ApiTimeoutError,
+    ApiUnauthorized,
+)
 from sentry.utils.http import absolute_uri
+from sentry.utils.retries import RetryException, TimedRetryPolicy
 from six.moves.urllib.parse import quote
 
 
 API_VERSION = u"/api/v4"
 
+# Responses GitLab sends while rate limiting or during maintenance windows.
+RETRYABLE_STATUS_CODES = frozenset([429, 502, 503, 504])
+MAX_REQUEST_ATTEMPTS = 3
+RETRY_BACKOFF = 0.2
+
+# The refresh request uses safe_urlopen's 30 second timeout, so the lock
+# must outlive it or a second worker could exchange the same refresh token.
+REFRESH_LOCK_DURATION = 60
+REFRESH_LOCK_TIMEOUT = 10
+
 
 class GitLabApiClientPath(object):
     oauth_token = u"/oauth/token"
@@ -72,8 +94,15 @@ class GitLabSetupClient(ApiClient):
 class GitLabApiClient(ApiClient):
     integration_name = "gitlab"
 
+    # Project listings are fetched repeatedly while rendering the issue and
+    # repository forms. Keep them briefly so a single form render only hits
+    # GitLab once without serving noticeably stale data.
+    cache_time = 60
+
     def __init__(self, installation):
         self.installation = installation
+        # Also read by BaseApiClient.build_url to build get_cached's keys.
+        self.base_url = self.metadata["base_url"]
         verify_ssl = self.metadata["verify_ssl"]
         self.is_refreshing_token = False
         super(GitLabApiClient, self).__init__(verify_ssl)
@@ -82,24 +111,59 @@ class GitLabApiClient(ApiClient):
     def identity(self):
         return self.installation.default_identity
 
-    @property
+    @cached_property
     def metadata(self):
         return self.installation.model.metadata
 
     def request(self, method, path, data=None, params=None):
-        access_token = self.identity.data["access_token"]
-        headers = {"Authorization": u"Bearer {}".format(access_token)}
-        url = GitLabApiClientPath.build_api_url(self.metadata["base_url"], path)
+        url = GitLabApiClientPath.build_api_url(self.base_url, path)
         try:
-            return self._request(method, url, headers=headers, data=data, params=params)
+            return self._request(
+                method, url, headers=self.get_auth_headers(), data=data, params=params
+            )
         except ApiUnauthorized as e:
             if self.is_refreshing_token:
                 raise e
             self.is_refreshing_token = True
-            self.refresh_auth()
-            resp = self._request(method, url, headers=headers, data=data, params=params)
-            self.is_refreshing_token = False
-            return resp
+            try:
+                self.refresh_auth()
+                # Retry with the refreshed token rather than the one that was rejected.
+                return self._request(
+                    method, url, headers=self.get_auth_headers(), data=data, params=params
+                )
+            finally:
+                self.is_refreshing_token = False
+
+    def get_cache_prefix(self):
+        # Visibility of projects depends on the token, and organizations
+        # sharing an integration each authenticate with their own identity,
+        # so cached responses must not be shared between identities.
+        return u"%s.%s.client:%s:" % (self.integration_type, self.name, self.identity.id)
+
+    def get_auth_headers(self):
+        return {"Authorization": u"Bearer {}".format(self.identity.data["access_token"])}
+
+    def _request(self, method, *args, **kwargs):
+        """
+        Retry idempotent requests that failed with a transient error,
+        backing off exponentially with jitter between attempts.
+        Timeouts and connection failures are not retried, as they carry
+        no response from GitLab and may already have taken the full timeout.
+        """
+        if method.upper() != "GET":
+            return super(GitLabApiClient, self)._request(method, *args, **kwargs)
+
+        attempt = 1
+        while True:
+            try:
+                return super(GitLabApiClient, self)._request(method, *args, **kwargs)
+            except (ApiHostError, ApiTimeoutError):
+                raise
+            except ApiError as e:
+                if e.code not in RETRYABLE_STATUS_CODES or attempt >= MAX_REQUEST_ATTEMPTS:
+                    raise
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1) + random.uniform(0, 0.1))
+                attempt += 1
 
     def refresh_auth(self):
         """
@@ -107,11 +171,30 @@ class GitLabApiClient(ApiClient):
         where Doorkeeper is a dependency for GitLab that handles OAuth
 
         https://github.com/doorkeeper-gem/doorkeeper/wiki/Enable-Refresh-Token-Credentials#testing-with-oauth2-gem
+
+        Concurrent workers using the same identity serialize on a lock so
+        that only one of them exchanges the refresh token. Workers that were
+        waiting on the lock pick up the token stored by the first one.
         """
-        self.identity.get_provider().refresh_identity(
-            self.identity,
-            refresh_token_url="%s%s" % (self.metadata["base_url"], GitLabApiClientPath.oauth_token),
+        stale_token = self.identity.data["access_token"]
+        lock = locks.get(
+            u"gitlab:refresh-auth:{}".format(self.identity.id), duration=REFRESH_LOCK_DURATION
         )
+        try:
+            with TimedRetryPolicy(REFRESH_LOCK_TIMEOUT)(lock.acquire):
+                identity = Identity.objects.get(id=self.identity.id)
+                if identity.data.get("access_token") == stale_token:
+                    identity.get_provider().refresh_identity(
+                        identity,
+                        refresh_token_url="%s%s" % (self.base_url, GitLabApiClientPath.oauth_token),
+                    )
+        except RetryException:
+            # Another worker is still holding the lock. Use its token if it
+            # has stored one by now, otherwise give up on this request.
+            identity = Identity.objects.get(id=self.identity.id)
+            if identity.data.get("access_token") == stale_token:
+                raise ApiUnauthorized("Timed out waiting for the access token to be refreshed")
+        self.installation.default_identity = identity
 
     def get_user(self):
         """Get a user
@@ -127,7 +210,7 @@ class GitLabApiClient(ApiClient):
         """
         # simple param returns limited fields for the project.
         # Really useful, because we often don't need most of the project information
-        return self.get(
+        return self.get_cached(
             GitLabApiClientPath.group_projects.format(group=group),
             params={
                 "search": query,
@@ -141,7 +224,7 @@ class GitLabApiClient(ApiClient):
 
         See https://docs.gitlab.com/ee/api/projects.html#get-single-project
         """
-        return self.get(GitLabApiClientPath.project.format(project=project_id))
+        return self.get_cached(GitLabApiClientPath.project.format(project=project_id))
 
     def get_issue(self, project_id, issue_id):
         """Get an issue
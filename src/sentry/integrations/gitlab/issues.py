@@ -1,22 +1,20 @@
 from __future__ import absolute_import
 
-import re
-
 from django.core.urlresolvers import reverse
 from sentry.shared_integrations.exceptions import ApiError, IntegrationError, ApiUnauthorized
 from sentry.integrations.issues import IssueBasicMixin
 from sentry.utils.http import absolute_uri
 
-ISSUE_EXTERNAL_KEY_FORMAT = re.compile(r".+:(.+)#(.+)")
-
 
 class GitlabIssueBasic(IssueBasicMixin):
     def make_external_key(self, data):
         return u"{}:{}".format(self.model.metadata["domain_name"], data["key"])
 
     def get_issue_url(self, key):
-        match = ISSUE_EXTERNAL_KEY_FORMAT.match(key)
-        project, issue_id = match.group(1), match.group(2)
+        # Keys look like `{domain_name}:{project_path}#{iid}`. The domain
+        # name may contain a port, so split on the last separators.
+        instance_and_project, _, issue_id = key.rpartition("#")
+        project = instance_and_project.rpartition(":")[2]
         return u"{}/{}/issues/{}".format(self.model.metadata["base_url"], project, issue_id)
 
     def get_persisted_default_config_fields(self):
@@ -0,0 +1,40 @@
+from __future__ import absolute_import
+
+import logging
+
+from django.http import Http404
+
+from sentry.models import Integration
+from sentry.tasks.base import instrumented_task, retry
+
+logger = logging.getLogger("sentry.webhooks")
+
+
+@instrumented_task(
+    name="sentry.integrations.gitlab.process_webhook",
+    queue="integrations",
+    default_retry_delay=60 * 5,
+    max_retries=5,
+)
+@retry(exclude=(Integration.DoesNotExist,))
+def process_webhook(integration_id, organization_id, event_type, event, **kwargs):
+    """
+    Apply an authenticated webhook payload to one of the organizations
+    sharing the integration. Handlers are idempotent so retries are safe.
+    """
+    from sentry.integrations.gitlab.webhooks import WEBHOOK_HANDLERS
+
+    integration = Integration.objects.get(id=integration_id)
+    try:
+        WEBHOOK_HANDLERS[event_type]()(integration, organization_id, event)
+    except Http404:
+        # The delivery was already acknowledged, so GitLab no longer sees a
+        # 404 for payloads the handlers reject. Log it instead of retrying.
+        logger.info(
+            "gitlab.webhook.unprocessable-event",
+            extra={
+                "integration_id": integration_id,
+                "organization_id": organization_id,
+                "event_type": event_type,
+            },
+        )
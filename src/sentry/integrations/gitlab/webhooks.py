@@ -17,16 +17,18 @@ from sentry.models import Commit, CommitAuthor, Integration, PullRequest, Reposi
 from sentry.plugins.providers import IntegrationRepositoryProvider
 from sentry.utils import json
 
+from .tasks import process_webhook
+
 logger = logging.getLogger("sentry.webhooks")
 
 PROVIDER_NAME = "integrations:gitlab"
 
 
 class Webhook(object):
-    def __call__(self, integration, organization, event):
+    def __call__(self, integration, organization_id, event):
         raise NotImplementedError
 
-    def get_repo(self, integration, organization, event):
+    def get_repo(self, integration, organization_id, event):
         """
         Given a webhook payload, get the associated Repository record.
 
@@ -43,7 +45,7 @@ class Webhook(object):
         external_id = u"{}:{}".format(integration.metadata["instance"], project_id)
         try:
             repo = Repository.objects.get(
-                organization_id=organization.id, provider=PROVIDER_NAME, external_id=external_id
+                organization_id=organization_id, provider=PROVIDER_NAME, external_id=external_id
             )
         except Repository.DoesNotExist:
             return None
@@ -88,8 +90,8 @@ class MergeEventWebhook(Webhook):
     See https://docs.gitlab.com/ee/user/project/integrations/webhooks.html#merge-request-events
     """
 
-    def __call__(self, integration, organization, event):
-        repo = self.get_repo(integration, organization, event)
+    def __call__(self, integration, organization_id, event):
+        repo = self.get_repo(integration, organization_id, event)
         if repo is None:
             return
 
@@ -113,19 +115,20 @@ class MergeEventWebhook(Webhook):
         except KeyError as e:
             logger.info(
                 "gitlab.webhook.invalid-merge-data",
-                extra={"integration_id": integration.id, "error": six.string_type(e)},
+                extra={"integration_id": integration.id, "error": six.text_type(e)},
             )
+            return
 
         if not author_email:
             raise Http404()
 
         author = CommitAuthor.objects.get_or_create(
-            organization_id=organization.id, email=author_email, defaults={"name": author_name}
+            organization_id=organization_id, email=author_email, defaults={"name": author_name}
         )[0]
 
         try:
             PullRequest.create_or_save(
-                organization_id=organization.id,
+                organization_id=organization_id,
                 repository_id=repo.id,
                 key=number,
                 values={
@@ -147,8 +150,8 @@ class PushEventWebhook(Webhook):
     See https://docs.gitlab.com/ee/user/project/integrations/webhooks.html#push-events
     """
 
-    def __call__(self, integration, organization, event):
-        repo = self.get_repo(integration, organization, event)
+    def __call__(self, integration, organization_id, event):
+        repo = self.get_repo(integration, organization_id, event)
         if repo is None:
             return
 
@@ -156,34 +159,58 @@ class PushEventWebhook(Webhook):
         # while we're here, make sure repo data is up to date
         # self.update_repo_data(repo, event)
 
-        authors = {}
-
         # TODO gitlab only sends a max of 20 commits. If a push contains
         # more commits they provide a total count and require additional API
         # requests to fetch the commit details
-        for commit in event.get("commits", []):
-            if IntegrationRepositoryProvider.should_ignore_commit(commit["message"]):
-                continue
-
+        commits = [
+            commit
+            for commit in event.get("commits", [])
+            if not IntegrationRepositoryProvider.should_ignore_commit(commit["message"])
+        ]
+
+        # Redeliveries and pushes of already known commits are common. Skip
+        # those up front rather than paying for a failed insert and rolled
+        # back savepoint per commit. The IntegrityError handling below still
+        # covers concurrent deliveries. Commits are not bulk inserted because
+        # post_save receivers (e.g. resolved_in_commit) must run for each.
+        existing_keys = set(
+            Commit.objects.filter(
+                repository_id=repo.id, key__in=[commit["id"] for commit in commits]
+            ).values_list("key", flat=True)
+        )
+        commits = [commit for commit in commits if commit["id"] not in existing_keys]
+
+        author_names = {}
+        for commit in commits:
             author_email = commit["author"]["email"]
-
             # TODO(dcramer): we need to deal with bad values here, but since
             # its optional, lets just throw it out for now
-            if author_email is None or len(author_email) > 75:
-                author = None
-            elif author_email not in authors:
-                authors[author_email] = author = CommitAuthor.objects.get_or_create(
-                    organization_id=organization.id,
+            if author_email is not None and len(author_email) <= 75:
+                author_names.setdefault(author_email, commit["author"]["name"])
+
+        # Fetch every known author of the push at once and only fall back to
+        # get_or_create for the ones we haven't seen before.
+        authors = {
+            author.email: author
+            for author in CommitAuthor.objects.filter(
+                organization_id=organization_id, email__in=list(author_names)
+            )
+        }
+        for author_email, author_name in six.iteritems(author_names):
+            if author_email not in authors:
+                authors[author_email] = CommitAuthor.objects.get_or_create(
+                    organization_id=organization_id,
                     email=author_email,
-                    defaults={"name": commit["author"]["name"]},
+                    defaults={"name": author_name},
                 )[0]
-            else:
-                author = authors[author_email]
+
+        for commit in commits:
+            author = authors.get(commit["author"]["email"])
             try:
                 with transaction.atomic():
                     Commit.objects.create(
                         repository_id=repo.id,
-                        organization_id=organization.id,
+                        organization_id=organization_id,
                         key=commit["id"],
                         message=commit["message"],
                         author=author,
@@ -195,10 +222,13 @@ class PushEventWebhook(Webhook):
                 pass
 
 
+WEBHOOK_HANDLERS = {"Push Hook": PushEventWebhook, "Merge Request Hook": MergeEventWebhook}
+
+
 class GitlabWebhookEndpoint(View):
     provider = "gitlab"
 
-    _handlers = {"Push Hook": PushEventWebhook, "Merge Request Hook": MergeEventWebhook}
+    _handlers = WEBHOOK_HANDLERS
 
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
@@ -221,11 +251,7 @@ class GitlabWebhookEndpoint(View):
             return HttpResponse(status=400)
 
         try:
-            integration = (
-                Integration.objects.filter(provider=self.provider, external_id=external_id)
-                .prefetch_related("organizations")
-                .get()
-            )
+            integration = Integration.objects.get(provider=self.provider, external_id=external_id)
         except Integration.DoesNotExist:
             logger.info(
                 "gitlab.webhook.invalid-organization",
@@ -240,21 +266,27 @@ class GitlabWebhookEndpoint(View):
             return HttpResponse(status=400)
 
         try:
-            event = json.loads(request.body.decode("utf-8"))
+            event = json.loads(request.body)
         except JSONDecodeError:
             logger.info(
                 "gitlab.webhook.invalid-json", extra={"external_id": integration.external_id}
             )
             return HttpResponse(status=400)
 
-        try:
-            handler = self._handlers[request.META["HTTP_X_GITLAB_EVENT"]]
-        except KeyError:
-            logger.info(
-                "gitlab.webhook.missing-event", extra={"event": request.META["HTTP_X_GITLAB_EVENT"]}
-            )
+        event_type = request.META.get("HTTP_X_GITLAB_EVENT")
+        if event_type not in self._handlers:
+            logger.info("gitlab.webhook.missing-event", extra={"event": event_type})
             return HttpResponse(status=400)
 
-        for organization in integration.organizations.all():
-            handler()(integration, organization, event)
+        # Writing commits and pull requests can take a while for large pushes,
+        # so do it out of band and acknowledge the delivery right away. Each
+        # organization sharing the integration is processed independently.
+        organization_ids = integration.organizations.values_list("id", flat=True)
+        for organization_id in organization_ids:
+            process_webhook.delay(
+                integration_id=integration.id,
+                organization_id=organization_id,
+                event_type=event_type,
+                event=event,
+            )
         return HttpResponse(status=204)
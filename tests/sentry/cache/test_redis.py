@@ -2,6 +2,11 @@
 
 from __future__ import absolute_import
 
+import pytz
+
+from datetime import datetime
+from uuid import UUID
+
 from sentry.cache.redis import RedisCache, ValueTooLarge
 from sentry.testutils import TestCase
 
@@ -23,3 +28,27 @@ class RedisCacheTest(TestCase):
 
         with self.assertRaises(ValueTooLarge):
             self.backend.set("foo", "x" * (RedisCache.max_size + 1), 0)
+
+    def test_msgpack_codec(self):
+        backend = RedisCache(codec="msgpack")
+        backend.set("foo", {"foo": u"b\xe4r", "baz": [1, 2]}, 50)
+
+        assert backend.get("foo") == {"foo": u"b\xe4r", "baz": [1, 2]}
+
+        # Values the JSON codec encodes must be accepted the same way.
+        value = {
+            "dateCreated": datetime(2020, 1, 2, 3, 4, 5, tzinfo=pytz.utc),
+            "id": UUID("e9f4a4bb-d1e0-4ebc-8c5b-d1bd7ac7e0f3"),
+            "tags": set(["foo"]),
+        }
+        backend.set("foo", value, 50)
+
+        assert backend.get("foo") == {
+            "dateCreated": "2020-01-02T03:04:05.000000Z",
+            "id": "e9f4a4bbd1e04ebc8c5bd1bd7ac7e0f3",
+            "tags": ["foo"],
+        }
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            RedisCache(codec="pickle")
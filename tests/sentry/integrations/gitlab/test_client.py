@@ -2,8 +2,13 @@ from __future__ import absolute_import
 import responses
 import pytest
 
+from requests.exceptions import ConnectTimeout
+
+from sentry.app import locks
 from sentry.auth.exceptions import IdentityNotValid
-from sentry.models import Identity
+from sentry.models import Identity, IdentityProvider
+from sentry.shared_integrations.exceptions import ApiError, ApiHostError, ApiUnauthorized
+from sentry.utils.compat.mock import patch
 from sentry.utils import json
 from .testutils import GitLabTestCase
 
@@ -101,6 +106,21 @@ class GitlabRefreshAuthTest(GitLabTestCase):
         assert resp == self.request_data
         self.assert_identity_was_refreshed()
 
+    @responses.activate
+    def test_refresh_auth_retries_with_new_token(self):
+        self.add_get_user_response(success=False)
+        self.add_get_user_response(success=True)
+        self.add_refresh_auth(success=True)
+
+        self.make_users_request()
+
+        responses_calls = responses.calls
+        assert responses_calls[0].request.headers["Authorization"] == "Bearer 123456789"
+        assert (
+            responses_calls[2].request.headers["Authorization"]
+            == "Bearer %s" % self.refresh_response["access_token"]
+        )
+
     @responses.activate
     def test_refresh_auth_fails_gracefully(self):
         self.add_get_user_response(success=False)
@@ -112,6 +132,58 @@ class GitlabRefreshAuthTest(GitLabTestCase):
         self.assert_request_failed_refresh()
         self.assert_identity_was_not_refreshed()
 
+    @responses.activate
+    def test_refresh_auth_skipped_when_token_already_refreshed(self):
+        self.add_get_user_response(success=False)
+        self.add_get_user_response(success=True)
+
+        # Another worker refreshed the identity after our token was loaded.
+        identity = Identity.objects.get(id=self.client.identity.id)
+        identity.update(data=dict(identity.data, **self.refresh_response))
+
+        resp = self.make_users_request()
+        assert resp == self.request_data
+
+        responses_calls = responses.calls
+        assert len(responses_calls) == 2
+        self.assert_response_call(responses_calls[0], self.request_url, 401)
+        self.assert_response_call(responses_calls[1], self.request_url, 200)
+        self.assert_data(self.client.identity.data, self.refresh_response)
+
+    def hold_refresh_lock(self):
+        lock = locks.get(u"gitlab:refresh-auth:{}".format(self.client.identity.id), duration=60)
+        lock.acquire()
+        self.addCleanup(lock.release)
+
+    @responses.activate
+    @patch("sentry.integrations.gitlab.client.REFRESH_LOCK_TIMEOUT", 0)
+    def test_refresh_auth_lock_timeout(self):
+        self.add_get_user_response(success=False)
+        self.add_refresh_auth(success=True)
+        self.hold_refresh_lock()
+
+        with pytest.raises(ApiUnauthorized):
+            self.make_users_request()
+
+        assert len(responses.calls) == 1
+        assert not self.client.is_refreshing_token
+        self.assert_identity_was_not_refreshed()
+
+    @responses.activate
+    @patch("sentry.integrations.gitlab.client.REFRESH_LOCK_TIMEOUT", 0)
+    def test_refresh_auth_lock_timeout_uses_stored_token(self):
+        self.add_get_user_response(success=False)
+        self.add_get_user_response(success=True)
+        self.hold_refresh_lock()
+
+        # The worker holding the lock stored a new token before we gave up.
+        identity = Identity.objects.get(id=self.client.identity.id)
+        identity.update(data=dict(identity.data, **self.refresh_response))
+
+        assert self.make_users_request() == self.request_data
+        assert len(responses.calls) == 2
+        self.assert_data(self.client.identity.data, self.refresh_response)
+
     @responses.activate
     def test_no_refresh_when_api_call_successful(self):
         self.add_get_user_response(success=True)
@@ -122,3 +194,87 @@ class GitlabRefreshAuthTest(GitLabTestCase):
         self.assert_response_call(call, self.request_url, 200)
         assert resp == self.request_data
         self.assert_identity_was_not_refreshed()
+
+
+class GitlabApiClientCacheTest(GitLabTestCase):
+    def setUp(self):
+        super(GitlabApiClientCacheTest, self).setUp()
+        self.client = self.installation.get_client()
+
+    @responses.activate
+    def test_get_project_is_cached(self):
+        responses.add(
+            responses.GET,
+            "https://example.gitlab.com/api/v4/projects/15",
+            json={"id": 15, "name_with_namespace": "cool-group / sentry"},
+        )
+
+        assert self.client.get_project(15)["id"] == 15
+        assert self.client.get_project(15)["id"] == 15
+        assert len(responses.calls) == 1
+
+    @responses.activate
+    def test_cache_is_not_shared_between_organizations(self):
+        responses.add(
+            responses.GET,
+            "https://example.gitlab.com/api/v4/projects/15",
+            json={"id": 15, "name_with_namespace": "cool-group / sentry"},
+        )
+        other_org = self.create_organization(owner=self.user)
+        other_identity = Identity.objects.create(
+            idp=IdentityProvider.objects.create(type=self.provider, config={}),
+            user=self.user,
+            external_id="gitlab456",
+            data={"access_token": "abcdef", "refresh_token": "fedcba"},
+        )
+        self.integration.add_organization(other_org, self.user, other_identity.id)
+        other_client = self.integration.get_installation(other_org.id).get_client()
+
+        assert self.client.get_project(15)["id"] == 15
+        assert other_client.get_project(15)["id"] == 15
+        assert len(responses.calls) == 2
+        assert responses.calls[1].request.headers["Authorization"] == "Bearer abcdef"
+
+
+@patch("sentry.integrations.gitlab.client.time.sleep")
+class GitlabApiClientRetryTest(GitLabTestCase):
+    request_url = "https://example.gitlab.com/api/v4/user"
+
+    def setUp(self):
+        super(GitlabApiClientRetryTest, self).setUp()
+        self.client = self.installation.get_client()
+
+    @responses.activate
+    def test_retries_transient_errors(self, mock_sleep):
+        responses.add(responses.GET, self.request_url, status=503)
+        responses.add(responses.GET, self.request_url, json={"id": "user_id"})
+
+        assert self.client.get_user() == {"id": "user_id"}
+        assert len(responses.calls) == 2
+        assert mock_sleep.call_count == 1
+
+    @responses.activate
+    def test_gives_up_after_max_attempts(self, mock_sleep):
+        responses.add(responses.GET, self.request_url, status=429)
+
+        with pytest.raises(ApiError):
+            self.client.get_user()
+        assert len(responses.calls) == 3
+
+    @responses.activate
+    def test_does_not_retry_client_errors(self, mock_sleep):
+        responses.add(responses.GET, self.request_url, status=404)
+
+        with pytest.raises(ApiError):
+            self.client.get_user()
+        assert len(responses.calls) == 1
+        assert mock_sleep.call_count == 0
+
+    @responses.activate
+    def test_does_not_retry_connection_errors(self, mock_sleep):
+        responses.add(responses.GET, self.request_url, body=ConnectTimeout())
+
+        with pytest.raises(ApiHostError):
+            self.client.get_user()
+        assert len(responses.calls) == 1
+        assert mock_sleep.call_count == 0
@@ -42,6 +42,13 @@ class GitlabIssuesTest(GitLabTestCase):
             == "https://example.gitlab.com/project/project/issues/7"
         )
 
+    def test_get_issue_url_domain_with_port(self):
+        issue_id = "example.gitlab.com:8080/group-x:project/project#7"
+        assert (
+            self.installation.get_issue_url(issue_id)
+            == "https://example.gitlab.com/project/project/issues/7"
+        )
+
     @responses.activate
     def test_get_create_issue_config(self):
         group_description = (
@@ -2,8 +2,10 @@ from __future__ import absolute_import
 
 import pytest
 
+from sentry.integrations.gitlab.tasks import process_webhook
 from sentry.models import Commit, CommitAuthor, PullRequest, GroupLink
 from sentry.utils import json
+from sentry.utils.compat.mock import patch
 from .testutils import (
     GitLabTestCase,
     WEBHOOK_TOKEN,
@@ -94,6 +96,25 @@ class WebhookTest(GitLabTestCase):
         # repositories enabled.
         assert response.status_code == 204
 
+    @patch("sentry.integrations.gitlab.webhooks.process_webhook")
+    def test_push_event_is_processed_async(self, mock_process_webhook):
+        self.create_repo("getsentry/sentry")
+        response = self.client.post(
+            self.url,
+            data=PUSH_EVENT,
+            content_type="application/json",
+            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+            HTTP_X_GITLAB_EVENT="Push Hook",
+        )
+        assert response.status_code == 204
+        assert 0 == Commit.objects.count()
+        mock_process_webhook.delay.assert_called_once_with(
+            integration_id=self.integration.id,
+            organization_id=self.organization.id,
+            event_type="Push Hook",
+            event=json.loads(PUSH_EVENT),
+        )
+
     def test_push_event_multiple_organizations_one_missing_repo(self):
         # Create a repo on the primary organization
         repo = self.create_repo("getsentry/sentry")
@@ -102,13 +123,14 @@ class WebhookTest(GitLabTestCase):
         other_org = self.create_organization(owner=self.user)
         self.integration.add_organization(other_org, self.user)
 
-        response = self.client.post(
-            self.url,
-            data=PUSH_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Push Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=PUSH_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Push Hook",
+            )
         assert response.status_code == 204
         commits = Commit.objects.all()
         assert len(commits) == 2
@@ -125,13 +147,14 @@ class WebhookTest(GitLabTestCase):
         self.integration.add_organization(other_org, self.user)
         other_repo = self.create_repo("getsentry/sentry", organization_id=other_org.id)
 
-        response = self.client.post(
-            self.url,
-            data=PUSH_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Push Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=PUSH_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Push Hook",
+            )
         assert response.status_code == 204
 
         commits = Commit.objects.filter(repository_id=repo.id).all()
@@ -146,13 +169,14 @@ class WebhookTest(GitLabTestCase):
 
     def test_push_event_create_commits_and_authors(self):
         repo = self.create_repo("getsentry/sentry")
-        response = self.client.post(
-            self.url,
-            data=PUSH_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Push Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=PUSH_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Push Hook",
+            )
         assert response.status_code == 204
 
         commits = Commit.objects.all()
@@ -173,15 +197,56 @@ class WebhookTest(GitLabTestCase):
             assert author.name
             assert author.organization_id == self.organization.id
 
+    def post_push_event(self):
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=PUSH_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Push Hook",
+            )
+        assert response.status_code == 204
+
+    def test_push_event_redelivery(self):
+        self.create_repo("getsentry/sentry")
+        self.post_push_event()
+
+        # Already stored commits are skipped without attempting an insert.
+        with patch.object(Commit.objects, "create") as mock_create:
+            self.post_push_event()
+        assert not mock_create.called
+
+        assert 2 == Commit.objects.count()
+        assert 2 == CommitAuthor.objects.count()
+
+    def test_push_event_known_authors_loaded_at_once(self):
+        for name, email in (("Jordi", "jordi@example.org"), ("Dev", "gitlabdev@example.org")):
+            CommitAuthor.objects.create(
+                organization_id=self.organization.id, email=email, name=name
+            )
+        self.create_repo("getsentry/sentry")
+
+        with patch.object(
+            CommitAuthor.objects, "filter", wraps=CommitAuthor.objects.filter
+        ) as mock_filter, patch.object(CommitAuthor.objects, "get_or_create") as mock_get_or_create:
+            self.post_push_event()
+        assert mock_filter.call_count == 1
+        assert not mock_get_or_create.called
+
+        assert 2 == Commit.objects.count()
+        assert 2 == CommitAuthor.objects.count()
+
     def test_push_event_ignore_commit(self):
         self.create_repo("getsentry/sentry")
-        response = self.client.post(
-            self.url,
-            data=PUSH_EVENT_IGNORED_COMMIT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Push Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=PUSH_EVENT_IGNORED_COMMIT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Push Hook",
+            )
         assert response.status_code == 204
         assert 0 == Commit.objects.count()
 
@@ -190,24 +255,26 @@ class WebhookTest(GitLabTestCase):
             organization_id=self.organization.id, email="jordi@example.org", name="Jordi"
         )
         self.create_repo("getsentry/sentry")
-        response = self.client.post(
-            self.url,
-            data=PUSH_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Push Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=PUSH_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Push Hook",
+            )
         assert response.status_code == 204
         assert 2 == CommitAuthor.objects.count(), "No dupes made"
 
     def test_merge_event_missing_repo(self):
-        response = self.client.post(
-            self.url,
-            data=MERGE_REQUEST_OPENED_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Merge Request Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=MERGE_REQUEST_OPENED_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Merge Request Hook",
+            )
         assert response.status_code == 204
         assert 0 == PullRequest.objects.count()
 
@@ -218,26 +285,28 @@ class WebhookTest(GitLabTestCase):
         # these important attributes. GitLab docs don't explain why though.
         del payload["object_attributes"]["last_commit"]
 
-        response = self.client.post(
-            self.url,
-            data=json.dumps(payload),
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Merge Request Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=json.dumps(payload),
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Merge Request Hook",
+            )
         assert response.status_code == 204
         assert 0 == PullRequest.objects.count()
 
     def test_merge_event_create_pull_request(self):
         self.create_repo("getsentry/sentry")
         group = self.create_group(project=self.project, short_id=9)
-        response = self.client.post(
-            self.url,
-            data=MERGE_REQUEST_OPENED_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Merge Request Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=MERGE_REQUEST_OPENED_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Merge Request Hook",
+            )
         assert response.status_code == 204
         author = CommitAuthor.objects.all().first()
         self.assert_commit_author(author)
@@ -246,6 +315,49 @@ class WebhookTest(GitLabTestCase):
         self.assert_pull_request(pull, author)
         self.assert_group_link(group, pull)
 
+    def test_merge_event_is_processed_by_task(self):
+        repo = self.create_repo("getsentry/sentry")
+        with self.tasks(), patch(
+            "sentry.integrations.gitlab.webhooks.process_webhook", wraps=process_webhook
+        ) as mock_process_webhook:
+            response = self.client.post(
+                self.url,
+                data=MERGE_REQUEST_OPENED_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Merge Request Hook",
+            )
+        assert response.status_code == 204
+        mock_process_webhook.delay.assert_called_once_with(
+            integration_id=self.integration.id,
+            organization_id=self.organization.id,
+            event_type="Merge Request Hook",
+            event=json.loads(MERGE_REQUEST_OPENED_EVENT),
+        )
+
+        pull = PullRequest.objects.get(repository_id=repo.id)
+        assert pull.organization_id == self.organization.id
+        assert pull.key == "1"
+        assert pull.title == "Create a new Viewport"
+        assert pull.author == CommitAuthor.objects.get(organization_id=self.organization.id)
+
+    @patch("sentry.integrations.gitlab.tasks.logger")
+    def test_merge_event_missing_author_is_logged(self, mock_logger):
+        self.create_repo("getsentry/sentry")
+        event = json.loads(MERGE_REQUEST_OPENED_EVENT)
+        event["object_attributes"]["last_commit"] = None
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=json.dumps(event),
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Merge Request Hook",
+            )
+        assert response.status_code == 204
+        assert 0 == PullRequest.objects.count()
+        assert mock_logger.info.call_args[0][0] == "gitlab.webhook.unprocessable-event"
+
     def test_merge_event_update_pull_request(self):
         repo = self.create_repo("getsentry/sentry")
         group = self.create_group(project=self.project, short_id=9)
@@ -257,13 +369,14 @@ class WebhookTest(GitLabTestCase):
             message="Old message",
         )
 
-        response = self.client.post(
-            self.url,
-            data=MERGE_REQUEST_OPENED_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Merge Request Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=MERGE_REQUEST_OPENED_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Merge Request Hook",
+            )
         assert response.status_code == 204
         author = CommitAuthor.objects.all().first()
         self.assert_commit_author(author)
@@ -287,13 +400,14 @@ class WebhookTest(GitLabTestCase):
             config=dict(repo_out_of_date_name.config, path="cool-group/sentry")
         )
 
-        response = self.client.post(
-            self.url,
-            data=PUSH_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Push Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=PUSH_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Push Hook",
+            )
 
         assert response.status_code == 204
 
@@ -312,13 +426,14 @@ class WebhookTest(GitLabTestCase):
             )
         )
 
-        response = self.client.post(
-            self.url,
-            data=PUSH_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Push Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=PUSH_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Push Hook",
+            )
 
         assert response.status_code == 204
 
@@ -336,13 +451,14 @@ class WebhookTest(GitLabTestCase):
             config=dict(repo_out_of_date_url.config, path="cool-group/sentry")
         )
 
-        response = self.client.post(
-            self.url,
-            data=PUSH_EVENT,
-            content_type="application/json",
-            HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
-            HTTP_X_GITLAB_EVENT="Push Hook",
-        )
+        with self.tasks():
+            response = self.client.post(
+                self.url,
+                data=PUSH_EVENT,
+                content_type="application/json",
+                HTTP_X_GITLAB_TOKEN=WEBHOOK_TOKEN,
+                HTTP_X_GITLAB_EVENT="Push Hook",
+            )
 
         assert response.status_code == 204
 